@@ -14,15 +14,22 @@ from __future__ import annotations
 import argparse
 import csv
 import io
+import os
+import tempfile
+import warnings
 import zipfile
 from collections import defaultdict
-from statistics import mean
+from functools import lru_cache
 from typing import Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
+import pandas as pd
+import xlsxwriter
 from openpyxl import load_workbook
 
 
-ValueMap = Dict[Tuple[str, int, str], float]
+# --agg name -> NaN-skipping row aggregator for gov_expected_changes.
+AGGREGATORS = {"mean": np.nanmean, "sum": np.nansum}
 
 
 def parse_args() -> argparse.Namespace:
@@ -34,7 +41,8 @@ def parse_args() -> argparse.Namespace:
     p.add_argument("--sheet", default=None, help="Worksheet name (default: first sheet)")
     p.add_argument("--country-col", default=None, help="Country column header in guide xlsx")
     p.add_argument("--year-col", default=None, help="Year column header in guide xlsx")
-    p.add_argument("--agg", choices=["mean", "sum"], default="mean", help="Aggregation for gov_expected_changes")
+    p.add_argument("--agg", choices=list(AGGREGATORS), default="mean", help="Aggregation for gov_expected_changes")
+    p.add_argument("--no-cache", action="store_true", help="Do not read/write the parsed WB cache (<wb-zip>.cache.npz)")
     return p.parse_args()
 
 
@@ -53,13 +61,22 @@ def _safe_float(x: str) -> Optional[float]:
 def load_mapping(path: str) -> List[Tuple[str, str, float]]:
     out: List[Tuple[str, str, float]] = []
     with open(path, "r", encoding="utf-8-sig", newline="") as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        header = next(reader, [])
+        try:
+            idx_delta = header.index("delta_col")
+            idx_indicator = header.index("indicator_code")
+        except ValueError:
+            raise ValueError("mapping 文件缺少 delta_col / indicator_code 列") from None
+        idx_direction = header.index("direction") if "direction" in header else None
+
         for row in reader:
-            delta_col = (row.get("delta_col") or "").strip()
-            indicator = (row.get("indicator_code") or "").strip()
+            n = len(row)
+            delta_col = row[idx_delta].strip() if idx_delta < n else ""
+            indicator = row[idx_indicator].strip() if idx_indicator < n else ""
             if not delta_col or not indicator:
                 continue
-            direction = _safe_float(row.get("direction", "1"))
+            direction = _safe_float(row[idx_direction]) if idx_direction is not None and idx_direction < n else None
             out.append((delta_col, indicator, direction if direction is not None else 1.0))
     if len(out) != 19:
         raise ValueError(f"mapping 文件需要包含 19 条映射，当前为 {len(out)} 条")
@@ -81,47 +98,208 @@ def find_data_csv_in_zip(zf: zipfile.ZipFile) -> str:
     return good[0] if good else candidates[0]
 
 
-def load_wb_values_from_zip(path: str) -> ValueMap:
-    values: ValueMap = {}
+# WB values are held as M[country_id, indicator_id, year - year0] (NaN = missing).
+WBValues = Tuple[np.ndarray, Dict[str, int], Dict[str, int], int]
+
+# Bump when the layout of M or the cached fields change; stale caches are then reparsed.
+WB_CACHE_LAYOUT = "M[country,indicator,year]-v1"
+
+
+def load_wb_values_from_zip(path: str, use_cache: bool = True) -> WBValues:
+    """Return (M, country_ids, indicator_ids, year0), M indexed [country_id, indicator_id, year - year0].
+
+    The parsed result is cached next to the zip as <path>.cache.npz and reused while
+    the zip's size and mtime and the cache format (layout tag, dtype of M) are unchanged.
+    """
+    cache_path = f"{path}.cache.npz"
+    if use_cache:
+        cached = _load_wb_cache(cache_path, path)
+        if cached is not None:
+            return cached
+
+    wb_data = _parse_wb_zip(path)
+    if use_cache:
+        _save_wb_cache(cache_path, path, wb_data)
+    return wb_data
+
+
+def _source_stamp(path: str) -> np.ndarray:
+    st = os.stat(path)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+def _cache_format() -> np.ndarray:
+    return np.array([WB_CACHE_LAYOUT, np.dtype(np.float64).str])
+
+
+def _load_wb_cache(cache_path: str, path: str) -> Optional[WBValues]:
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as npz:
+            if not np.array_equal(npz["format"], _cache_format()):
+                return None
+            if not np.array_equal(npz["source"], _source_stamp(path)):
+                return None
+            M = npz["M"]
+            country_ids = {c: i for i, c in enumerate(npz["countries"].tolist())}
+            indicator_ids = {c: i for i, c in enumerate(npz["indicators"].tolist())}
+            year0 = int(npz["year0"])
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        return None  # unreadable / old-format cache: reparse and overwrite it
+    return M, country_ids, indicator_ids, year0
+
+
+def _save_wb_cache(cache_path: str, path: str, wb_data: WBValues) -> None:
+    M, country_ids, indicator_ids, year0 = wb_data
+    # A unique temp name per run, so concurrent runs never write into the same file.
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(cache_path) or ".",
+            prefix=os.path.basename(cache_path) + ".",
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            tmp_path = f.name
+            np.savez_compressed(
+                f,
+                M=M,
+                countries=np.array(list(country_ids), dtype=str),
+                indicators=np.array(list(indicator_ids), dtype=str),
+                year0=year0,
+                source=_source_stamp(path),
+                format=_cache_format(),
+            )
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+    except OSError as e:
+        print(f"Warning: 无法写入缓存 {cache_path}: {e}")
+    finally:
+        # Also covers interrupts, so no half-written temp file is left next to the zip.
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def _read_wb_csv(zf: zipfile.ZipFile, name: str, **kwargs) -> pd.DataFrame:
+    # Decode while decompressing instead of materialising the bytes and the str copy.
+    with zf.open(name, "r") as raw_f:
+        text_f = io.TextIOWrapper(raw_f, encoding="utf-8-sig", errors="replace", newline="")
+        return pd.read_csv(text_f, **kwargs)
+
+
+def _parse_wb_zip(path: str) -> WBValues:
     with zipfile.ZipFile(path, "r") as zf:
         data_name = find_data_csv_in_zip(zf)
-        raw = zf.read(data_name)
-
-    text = raw.decode("utf-8-sig", errors="replace")
-    reader = csv.DictReader(io.StringIO(text))
-
-    # WB standard columns.
-    country_col = None
-    indicator_col = None
-    for c in reader.fieldnames or []:
-        cl = c.lower()
-        if country_col is None and ("country code" == cl or "country_code" == cl.replace(" ", "_")):
-            country_col = c
-        if indicator_col is None and ("indicator code" == cl or "indicator_code" == cl.replace(" ", "_")):
-            indicator_col = c
-    if not country_col or not indicator_col:
-        raise ValueError("未识别到 Country Code / Indicator Code 列")
-
-    year_cols = [c for c in (reader.fieldnames or []) if c.strip().isdigit()]
-    if not year_cols:
-        raise ValueError("未识别到年份列（如 1960..2023）")
-
-    for row in reader:
-        country = (row.get(country_col) or "").strip()
-        indicator = (row.get(indicator_col) or "").strip()
-        if not country or not indicator:
-            continue
-        for yc in year_cols:
-            v = _safe_float(row.get(yc, ""))
-            if v is None:
-                continue
-            values[(country, int(yc), indicator)] = v
+        columns = list(_read_wb_csv(zf, data_name, nrows=0).columns)
+
+        # WB standard columns.
+        country_col = None
+        indicator_col = None
+        for c in columns:
+            cl = c.lower()
+            if country_col is None and ("country code" == cl or "country_code" == cl.replace(" ", "_")):
+                country_col = c
+            if indicator_col is None and ("indicator code" == cl or "indicator_code" == cl.replace(" ", "_")):
+                indicator_col = c
+        if not country_col or not indicator_col:
+            raise ValueError("未识别到 Country Code / Indicator Code 列")
+
+        year_cols = [c for c in columns if c.strip().isdigit()]
+        if not year_cols:
+            raise ValueError("未识别到年份列（如 1960..2023）")
+
+        # Only the id columns are kept as text; the C parser turns year cells into floats.
+        df = _read_wb_csv(
+            zf,
+            data_name,
+            usecols=[country_col, indicator_col, *year_cols],
+            dtype={country_col: str, indicator_col: str},
+            keep_default_na=False,
+            na_values={c: ["", ".."] for c in year_cols},
+        )
+
+    df[country_col] = df[country_col].str.strip()
+    df[indicator_col] = df[indicator_col].str.strip()
+    df = df[(df[country_col] != "") & (df[indicator_col] != "")]
+
+    cid, country_codes = pd.factorize(df[country_col])
+    iid, indicator_codes = pd.factorize(df[indicator_col])
+    country_ids = {c: i for i, c in enumerate(country_codes)}
+    indicator_ids = {c: i for i, c in enumerate(indicator_codes)}
+
+    # The wide layout already is (country, indicator) x year: scatter it straight into M.
+    years = np.array([int(c) for c in year_cols])
+    year0 = int(years.min())
+    vals = df[year_cols]
+    # A year column holding anything non-numeric comes back as text; coerce just those.
+    text_cols = [c for c in year_cols if not pd.api.types.is_numeric_dtype(vals[c])]
+    if text_cols:
+        vals = vals.assign(**{c: pd.to_numeric(vals[c], errors="coerce") for c in text_cols})
+    vals = vals.to_numpy(dtype=np.float64)
+    M = np.full((len(country_codes), len(indicator_codes), int(years.max()) - year0 + 1), np.nan, dtype=np.float64)
+    M[cid[:, None], iid[:, None], (years - year0)[None, :]] = vals
+    return M, country_ids, indicator_ids, year0
+
+
+def compute_deltas(
+    wb_data: WBValues,
+    countries: pd.Series,
+    years: np.ndarray,
+    mapping: List[Tuple[str, str, float]],
+    agg: str,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (deltas, gov) for each guide row; deltas has one column per mapping entry."""
+    M, country_ids, indicator_ids, year0 = wb_data
+    n_years = M.shape[2]
+    iids = np.array(
+        [indicator_ids.get(indicator, -1) for _delta_col, indicator, _direction in mapping],
+        dtype=np.int64,
+    )
+    directions = np.array([direction for _delta_col, _indicator, direction in mapping], dtype=float)
+    agg_fn = AGGREGATORS[agg]
+
+    # Translate guide rows to tensor indices once; -1 marks rows that cannot match.
+    rc = pd.Index(list(country_ids)).get_indexer(countries).astype(np.int64)
+    in_range = (years >= year0) & (years < year0 + n_years)  # False for NaN
+    ry = np.where(in_range, years - year0, -1).astype(np.int64)
+
+    # Only year and year - 1 are ever read: take the directed year-over-year differences
+    # of the mapped indicators once, laid out D[country_id, year - year0, k] so that the
+    # mapping entries of one (country, year) are contiguous, then gather whole rows.
+    cols = iids >= 0
+    D = np.full((M.shape[0], n_years, iids.size), np.nan)
+    D[:, 1:, cols] = np.diff(M[:, iids[cols]].transpose(0, 2, 1), axis=1)
+    D *= directions
+
+    # Guides often repeat a (country, year) across rows: gather and aggregate each
+    # distinct pair once, then fan the results back out to the rows.
+    rows = np.flatnonzero((rc >= 0) & (ry >= 0))
+    pairs, inverse = np.unique(rc[rows] * n_years + ry[rows], return_inverse=True)
+    pair_deltas = D[pairs // n_years, pairs % n_years]
+    with warnings.catch_warnings():
+        # All-NaN rows make nanmean warn ("Mean of empty slice"); they are reset below.
+        warnings.simplefilter("ignore", RuntimeWarning)
+        pair_gov = agg_fn(pair_deltas, axis=1)
+    pair_gov[np.isnan(pair_deltas).all(axis=1)] = np.nan
+
+    deltas = np.full((len(countries), iids.size), np.nan)
+    gov = np.full(len(countries), np.nan)
+    deltas[rows] = pair_deltas[inverse]
+    gov[rows] = pair_gov[inverse]
+    return deltas, gov
+
 
-    return values
+def _normalize_header(x) -> str:
+    return _normalize_header_str(str(x))
 
 
-def _normalize_header(x: str) -> str:
-    return str(x).strip().lower().replace("_", " ")
+@lru_cache(maxsize=None)
+def _normalize_header_str(x: str) -> str:
+    return x.strip().lower().replace("_", " ")
 
 
 def find_header_col(header_map: Dict[str, int], preferred: Optional[str], fallbacks: Iterable[str]) -> int:
@@ -137,40 +315,79 @@ def find_header_col(header_map: Dict[str, int], preferred: Optional[str], fallba
     raise ValueError(f"找不到列，尝试过: {', '.join(fallbacks)}")
 
 
-def as_country_code(v) -> str:
-    if v is None:
-        return ""
-    s = str(v).strip()
-    if len(s) == 3 and s.isalpha():
-        return s.upper()
-    return s.upper()
+def as_country_codes(col: pd.Series) -> pd.Series:
+    return col.fillna("").astype(str).str.strip().str.upper()
 
 
-def as_year(v) -> Optional[int]:
-    if v is None:
-        return None
-    s = str(v).strip()
-    if not s:
-        return None
-    try:
-        return int(float(s))
-    except ValueError:
-        return None
+def as_years(col: pd.Series) -> np.ndarray:
+    """Truncated numeric years as float; NaN where the cell is empty or not a number."""
+    years = pd.to_numeric(col, errors="coerce").to_numpy(dtype=float)
+    return np.trunc(np.where(np.isfinite(years), years, np.nan))
+
+
+SheetFormulas = Dict[int, List[int]]
+
+
+def read_sheet(wb, name: str) -> Tuple[pd.DataFrame, SheetFormulas]:
+    """Raw cell values of a sheet (None for empty) and the formula cells as {row: [cols]}.
+
+    The workbook is opened with data_only=False, so formula cells hold their formula
+    text ("=1+1"): files saved by openpyxl/pandas carry no cached results to read instead.
+    """
+    ws = wb[name]
+    # Read-only mode trusts the stored <dimension>, which may be missing or stale
+    # (e.g. files written by other tools); drop it and let iter_rows find the real extent.
+    ws.reset_dimensions()
+    rows: List[list] = []
+    formulas: SheetFormulas = {}
+    for r, cells in enumerate(ws.iter_rows()):
+        values = []
+        for c, cell in enumerate(cells):
+            v = cell.value
+            if cell.data_type == "f":
+                formulas.setdefault(r, []).append(c)
+                v = getattr(v, "text", v)  # ArrayFormula -> its formula text
+            values.append(v)
+        rows.append(values)
+    width = max(map(len, rows), default=0)
+    for row in rows:
+        row.extend([None] * (width - len(row)))
+    return pd.DataFrame(rows, columns=range(width), dtype=object), formulas
+
+
+def _write_formulas(ws_out, r: int, values: list, cols: Iterable[int]) -> None:
+    for c in cols:
+        ws_out.write_formula(r, c, values[c])
+
+
+def _copy_sheet(src: pd.DataFrame, formulas: SheetFormulas, dst) -> None:
+    write_row = dst.write_row
+    for r, row in enumerate(src.values.tolist()):
+        write_row(r, 0, row)
+        _write_formulas(dst, r, row, formulas.get(r, ()))
 
 
 def main() -> None:
     args = parse_args()
     mapping = load_mapping(args.mapping_csv)
-    wb_values = load_wb_values_from_zip(args.wb_zip)
-
-    wb = load_workbook(args.guide_xlsx)
-    ws = wb[args.sheet] if args.sheet else wb[wb.sheetnames[0]]
+    wb_data = load_wb_values_from_zip(args.wb_zip, use_cache=not args.no_cache)
+
+    # Read the guide with read-only openpyxl (formulas kept as formulas); the result is
+    # written straight out with xlsxwriter in constant_memory mode. Chartsheets hold no
+    # cells and are skipped.
+    wb_in = load_workbook(args.guide_xlsx, read_only=True, data_only=False)
+    worksheets = [ws.title for ws in wb_in.worksheets]
+    sheet_name = args.sheet or worksheets[0]
+    if sheet_name not in worksheets:
+        raise ValueError(f"找不到工作表: {sheet_name}")
+    guide, guide_formulas = read_sheet(wb_in, sheet_name)
+    header = guide.iloc[0].tolist() if len(guide) else []
+    body = guide.iloc[1:]
+    n_existing = len(header)
 
     # header index map (normalized -> 1-based col index)
     header_map: Dict[str, int] = {}
-    max_col = ws.max_column
-    for c in range(1, max_col + 1):
-        val = ws.cell(row=1, column=c).value
+    for c, val in enumerate(header, start=1):
         if val is None:
             continue
         header_map[_normalize_header(val)] = c
@@ -187,54 +404,83 @@ def main() -> None:
     )
 
     # Ensure delta columns + gov_expected_changes exist.
-    next_col = ws.max_column + 1
     delta_col_indices: Dict[str, int] = {}
-    for delta_col, _indicator, _direction in mapping:
-        key = _normalize_header(delta_col)
+    normalized_mapping = [(_normalize_header(dc), dc, ind, dr) for dc, ind, dr in mapping]
+    for key, delta_col, _indicator, _direction in normalized_mapping:
         if key in header_map:
             delta_col_indices[delta_col] = header_map[key]
         else:
-            ws.cell(row=1, column=next_col, value=delta_col)
-            delta_col_indices[delta_col] = next_col
-            header_map[key] = next_col
-            next_col += 1
+            header.append(delta_col)
+            delta_col_indices[delta_col] = len(header)
+            header_map[key] = len(header)
 
     gov_col_name = "gov_expected_changes"
     gov_key = _normalize_header(gov_col_name)
     if gov_key in header_map:
         gov_col_idx = header_map[gov_key]
     else:
-        ws.cell(row=1, column=next_col, value=gov_col_name)
-        gov_col_idx = next_col
-
-    for r in range(2, ws.max_row + 1):
-        country = as_country_code(ws.cell(row=r, column=country_col_idx).value)
-        year = as_year(ws.cell(row=r, column=year_col_idx).value)
-
-        row_deltas: List[float] = []
-        if country and year is not None:
-            for delta_col, indicator, direction in mapping:
-                cur = wb_values.get((country, year, indicator))
-                pre = wb_values.get((country, year - 1, indicator))
-                target_idx = delta_col_indices[delta_col]
-                if cur is None or pre is None:
-                    ws.cell(row=r, column=target_idx, value=None)
-                    continue
-                d = direction * (cur - pre)
-                ws.cell(row=r, column=target_idx, value=d)
-                row_deltas.append(d)
-        else:
-            for delta_col, _indicator, _direction in mapping:
-                ws.cell(row=r, column=delta_col_indices[delta_col], value=None)
-
-        if not row_deltas:
-            ws.cell(row=r, column=gov_col_idx, value=None)
-        elif args.agg == "sum":
-            ws.cell(row=r, column=gov_col_idx, value=sum(row_deltas))
-        else:
-            ws.cell(row=r, column=gov_col_idx, value=mean(row_deltas))
+        header.append(gov_col_name)
+        gov_col_idx = len(header)
+
+    country_idx0 = country_col_idx - 1
+    year_idx0 = year_col_idx - 1
+    gov_idx0 = gov_col_idx - 1
+    delta_idx0 = [delta_col_indices[delta_col] - 1 for delta_col, _indicator, _direction in mapping]
+
+    # Output slot k (deltas..., gov) -> 0-based column. Columns that already existed
+    # in the guide may hold stale values and are overwritten (None clears them);
+    # columns added this run start empty, so only real numbers are written there.
+    out_idx0 = delta_idx0 + [gov_idx0]
+    old_slots = [(k, idx0) for k, idx0 in enumerate(out_idx0) if idx0 < n_existing]
+    new_slots = [(k, idx0) for k, idx0 in enumerate(out_idx0) if idx0 >= n_existing]
+
+    if any(c in (country_idx0, year_idx0) for r, cols in guide_formulas.items() if r > 0 for c in cols):
+        print("Warning: 国家/年份列中含公式单元格，公式不会被计算，这些行不会匹配到世界银行数据")
+
+    countries = as_country_codes(body.iloc[:, country_idx0])
+    years = as_years(body.iloc[:, year_idx0])
+    deltas, gov = compute_deltas(wb_data, countries, years, mapping, args.agg)
+
+    wb_out = xlsxwriter.Workbook(
+        args.output,
+        {
+            "constant_memory": True,
+            "default_date_format": "yyyy-mm-dd",
+            # Copy cell text verbatim instead of turning it into formulas/links.
+            "strings_to_formulas": False,
+            "strings_to_urls": False,
+        },
+    )
+    overwritten = {idx0 for _k, idx0 in old_slots}
+    for name in wb_in.sheetnames:
+        if name not in worksheets:
+            print(f"Warning: 跳过图表工作表 {name}（输出不保留图表）")
+            continue
+        if name != sheet_name:
+            _copy_sheet(*read_sheet(wb_in, name), wb_out.add_worksheet(name))
+            continue
 
-    wb.save(args.output)
+        ws_out = wb_out.add_worksheet(name)
+        write_row = ws_out.write_row
+        write_number = ws_out.write_number
+        write_row(0, 0, header)
+        _write_formulas(ws_out, 0, header, guide_formulas.get(0, ()))
+        out_rows = np.column_stack([deltas, gov]).tolist()
+        for r, (values, row_out) in enumerate(zip(body.values.tolist(), out_rows), start=1):
+            for k, idx0 in old_slots:
+                v = row_out[k]
+                values[idx0] = v if v == v else None
+            write_row(r, 0, values)
+            formula_cols = guide_formulas.get(r)
+            if formula_cols:
+                _write_formulas(ws_out, r, values, [c for c in formula_cols if c not in overwritten])
+            for k, idx0 in new_slots:
+                v = row_out[k]
+                if v == v:  # NaN -> leave the new cell empty
+                    write_number(r, idx0, v)
+
+    wb_out.close()
+    wb_in.close()
     print(f"Done. Saved: {args.output}")
 
 